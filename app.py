@@ -1,11 +1,24 @@
 from dash import Dash, dcc, html, Input, Output, State, callback_context
 from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
+import plotly.io as pio
 import pandas as pd
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
 import base64
+import hashlib
 import io
+import os
+import tempfile
 import dash
-from dash import ALL
+from dash import ALL, dash_table
+from flask_caching import Cache
+
+# Serialize figures with orjson rather than Plotly's pure-Python JSON encoder
+pio.json.config.default_engine = 'orjson'
+
 # Initialize the Dash app
 app = Dash(__name__, 
     external_stylesheets=[
@@ -14,58 +27,160 @@ app = Dash(__name__,
     suppress_callback_exceptions=True
 )
 
+# Server-side cache of parsed uploads, keyed by a digest of the file contents.
+# File-backed so every gunicorn worker on the host sees the same entries.
+cache = Cache(app.server, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': os.path.join(tempfile.gettempdir(), 'booking-frequency-cache'),
+    'CACHE_DEFAULT_TIMEOUT': 3600
+})
+
 def create_frequency_table(data, period=None, start_period=None, end_period=None, max_upper=10):
     """Process data to create frequency table"""
     if period:
-        data_filtered = data[data["Start_Date_time"].dt.to_period("M").astype(str) == period]
+        lo = hi = pd.Period(period, "M").ordinal
     elif start_period and end_period:
-        periods = data["Start_Date_time"].dt.to_period("M").astype(str)
-        data_filtered = data[(periods >= start_period) & (periods <= end_period)]
+        lo = pd.Period(start_period, "M").ordinal
+        hi = pd.Period(end_period, "M").ordinal
     else:
         return None
 
-    # Exclude "Self Practice"
-    data_filtered = data_filtered[~data_filtered["Class_Name"].str.contains("Self Practice", case=False, na=False)]
+    # Rows are sorted by period at upload, so the selection is a contiguous slice
+    periods = data["_period"].values
+    data_filtered = data.iloc[np.searchsorted(periods, lo, "left"):np.searchsorted(periods, hi, "right")]
+
+    # Exclude "Self Practice" and count bookings per student
+    students = (
+        pl.from_pandas(data_filtered[["Id_Person", "FirstName", "_is_self_practice"]])
+        .lazy()
+        .filter(~pl.col("_is_self_practice"))
+        .filter(pl.col("Id_Person").is_not_null())
+        .group_by("Id_Person")
+        .agg(pl.len().alias("n"), pl.col("FirstName").first())
+        .sort("Id_Person")
+        .collect()
+        .to_pandas()
+        .set_index("Id_Person")
+    )
+    booking_frequencies = students["n"]
 
-    # Calculate booking frequencies
-    booking_frequencies = data_filtered.groupby("Id_Person").size()
+    # Bin each student by frequency; everything above max_upper shares the last bin
+    buckets = np.minimum(booking_frequencies.values, max_upper + 1)
+    counts = np.bincount(buckets, minlength=max_upper + 2)[1:]
+    total = len(booking_frequencies)
+    cumulative = np.cumsum(counts[:max_upper])
 
     # Create frequency table
     table = pd.DataFrame({
         "Freq": list(range(1, max_upper + 1)) + [f">{max_upper}"],
-        "#Students": [sum(booking_frequencies == i) for i in range(1, max_upper + 1)] + 
-                    [sum(booking_frequencies > max_upper)],
-        "Cum 1->": [sum(booking_frequencies <= i) for i in range(1, max_upper + 1)] + 
-                  [len(booking_frequencies)],
-        "Cum ->End": [len(booking_frequencies) - sum(booking_frequencies <= i) for i in range(1, max_upper + 1)] + 
-                    [sum(booking_frequencies > max_upper)]
+        "#Students": counts.tolist(),
+        "Cum 1->": cumulative.tolist() + [total],
+        "Cum ->End": (total - cumulative).tolist() + [int(counts[max_upper])]
     })
 
-    # Add student details
-    def get_student_details(freq):
-        if isinstance(freq, str) and freq.startswith(">"):
-            ids = booking_frequencies[booking_frequencies > max_upper].index
-        else:
-            ids = booking_frequencies[booking_frequencies == freq].index
-        
-        names = data_filtered[data_filtered["Id_Person"].isin(ids)]["FirstName"].drop_duplicates()
-        return ", ".join([f"{name} : {id}" for name, id in zip(names, ids)])
-
-    table["Details"] = [get_student_details(freq) for freq in table["Freq"]]
+    # Add student details, grouping students by frequency bin in a single pass
+    name_by_id = students["FirstName"].to_dict()
+    details = pd.Series(booking_frequencies.index).groupby(buckets).agg(
+        lambda ids: ", ".join(f"{name_by_id[i]} : {i}" for i in ids)
+    )
+    table["Details"] = details.reindex(range(1, max_upper + 2), fill_value="").tolist()
     return table
 
+def create_histogram(table, title):
+    """Build the frequency histogram with mean and median markers"""
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=table["Freq"].astype(str),
+        y=table["#Students"],
+        text=table["#Students"],
+        textposition='auto',
+        hovertemplate="<b>Frequency:</b> %{x}<br>" +
+                     "<b>Students:</b> %{y}<br>" +
+                     "<b>Details:</b> %{customdata}<extra></extra>",
+        customdata=table["Details"]
+    ))
+
+    # Calculate and add mean and median lines
+    # Bins are 1..max_upper in order; the ">max_upper" bin counts as max_upper
+    counts = table["#Students"].to_numpy()
+    freqs = np.minimum(np.arange(1, len(counts) + 1), len(counts) - 1)
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+
+    if total:
+        mean_val = (freqs * counts).sum() / total
+        # Bin holding the student at sorted position total//2
+        median_val = freqs[np.searchsorted(cumulative, total // 2, side="right")]
+
+        fig.add_vline(x=mean_val, line_dash="dash", line_color="red",
+                     annotation_text=f"Mean: {mean_val:.2f}",
+                     annotation_position="top right",
+                     annotation_y=1.1)
+
+        fig.add_vline(x=median_val, line_dash="dash", line_color="green",
+                     annotation_text=f"Median: {median_val:.2f}",
+                     annotation_position="bottom right",
+                     annotation_y=0.9)
+
+    fig.update_layout(
+        title=title,
+        xaxis_title='Frequency of Bookings',
+        yaxis_title='Number of Students',
+        height=500
+    )
+    return fig
+
+def excel_writer(table):
+    """Return a dcc.send_bytes writer that saves the table to XLSX with xlsxwriter"""
+    def write(buffer):
+        # No constant_memory: pandas writes column by column, which that mode silently drops
+        table.to_excel(buffer, sheet_name="Frequency Analysis", engine="xlsxwriter")
+    return write
+
 def parse_contents(contents):
     """Parse uploaded file contents"""
     content_type, content_string = contents.split(',')
     decoded = base64.b64decode(content_string)
     
     try:
-        df = pd.read_excel(io.BytesIO(decoded))
-        df["Start_Date_time"] = pd.to_datetime(df["Start_Date_time"], errors="coerce")
+        df = pd.read_excel(io.BytesIO(decoded), engine="calamine", dtype_backend="pyarrow")
+        # Period arithmetic needs a NumPy datetime column
+        df["Start_Date_time"] = pd.to_datetime(df["Start_Date_time"], errors="coerce").astype("datetime64[ns]")
+        # Monthly period as an integer ordinal, computed once per upload
+        df["_period"] = df["Start_Date_time"].dt.to_period("M").array.asi8
+        df = df.sort_values("_period", kind="stable").reset_index(drop=True)
+        df["_is_self_practice"] = (
+            pc.match_substring(pa.array(df["Class_Name"]).cast(pa.string()), "Self Practice", ignore_case=True)
+            .fill_null(False)
+            .to_numpy(zero_copy_only=False)
+        )
+        # Shrink the frame: low-cardinality labels as categories, ids as the smallest integer type
+        for column in ("Class_Name", "FirstName"):
+            # Blank columns arrive as Arrow null type, which cannot become a category
+            if df[column].notna().any():
+                df[column] = df[column].astype("category")
+        if pd.api.types.is_integer_dtype(df["Id_Person"]):
+            df["Id_Person"] = pd.to_numeric(df["Id_Person"], downcast="unsigned")
         return df, None
     except Exception as e:
         return None, str(e)
 
+def load_dataframe(stored_data):
+    """Return the parsed upload from the server cache"""
+    df = cache.get(stored_data['key'])
+    if df is None:
+        raise ValueError("Uploaded data has expired, please upload the file again")
+    return df
+
+def get_frequency_table(stored_data, period=None, start_period=None, end_period=None, max_upper=10):
+    """Return the frequency table for an upload, reusing the result of an identical earlier analysis"""
+    key = f"table:{stored_data['key']}:{period}:{start_period}:{end_period}:{max_upper}"
+    table = cache.get(key)
+    if table is None:
+        table = create_frequency_table(load_dataframe(stored_data), period, start_period, end_period, max_upper)
+        cache.set(key, table)
+    return table
+
 # App Layout
 app.layout = html.Div([
     # Main container
@@ -153,6 +268,7 @@ app.layout = html.Div([
 
      # Store components for data
     dcc.Store(id='stored-data'),
+    dcc.Store(id='last-table'),
     dcc.Download(id="download-xlsx"),
     dcc.Loading(
         id="loading-upload",
@@ -182,13 +298,15 @@ def store_data(contents, filename):
     if error:
         return None, f"Error: {error}", "mt-2 text-red-600", ""  # Added ""
     
+    key = hashlib.blake2b(contents.encode()).hexdigest()
+    cache.set(key, df)
+
     return {
-        'data': df.to_json(date_format='iso', orient='split'),
-        'filename': filename
+        'key': key,
+        'filename': filename,
+        'periods': sorted(df["Start_Date_time"].dt.to_period("M").dropna().unique().astype(str).tolist())
     }, f"File uploaded: {filename}", "mt-2 text-green-600", ""  # Added ""
 
-from io import StringIO
-
 @app.callback(
     Output('period-selector', 'children'),
     [Input('stored-data', 'data'),
@@ -198,8 +316,7 @@ def update_period_selector(stored_data, analysis_type):
     if not stored_data:
         raise PreventUpdate
 
-    data = pd.read_json(StringIO(stored_data['data']), orient='split')
-    periods = sorted(data["Start_Date_time"].dt.to_period("M").astype(str).unique())
+    periods = stored_data['periods']
     return get_monthly_selector(periods) if analysis_type == 'Monthly' else get_range_selector(periods)
 
 def get_monthly_selector(periods):
@@ -236,7 +353,8 @@ def get_range_selector(periods):
      Output('results-section', 'style'),
      Output('status-message', 'children'),
      Output('status-message', 'className'),
-     Output('analysis-output', 'children')],
+     Output('analysis-output', 'children'),
+     Output('last-table', 'data')],
     Input('run-analysis', 'n_clicks'),
     [State('stored-data', 'data'),
      State('analysis-type', 'value'),
@@ -248,119 +366,54 @@ def update_outputs(n_clicks, stored_data, analysis_type, max_upper, period_value
         raise PreventUpdate
 
     try:
-        data = pd.read_json(StringIO(stored_data['data']), orient='split')
-        
         if analysis_type == 'Monthly':
             period_value = period_values[0] if period_values else None
             if not period_value:
                 raise ValueError("Please select a period")
-            table = create_frequency_table(data, period=period_value, max_upper=max_upper)
+            table = get_frequency_table(stored_data, period=period_value, max_upper=max_upper)
         else:
             if len(period_values) < 2:
                 raise ValueError("Please select start and end periods")
-            table = create_frequency_table(data, start_period=period_values[0], 
+            table = get_frequency_table(stored_data, start_period=period_values[0],
                                         end_period=period_values[1], max_upper=max_upper)
 
-        # Create histogram
-        fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=table["Freq"].astype(str),
-            y=table["#Students"],
-            text=table["#Students"],
-            textposition='auto',
-            hovertemplate="<b>Frequency:</b> %{x}<br>" +
-                         "<b>Students:</b> %{y}<br>" +
-                         "<b>Details:</b> %{customdata}<extra></extra>",
-            customdata=table["Details"]
-        ))
-
-        # Calculate and add mean and median lines
-        freq_data = []
-        for freq, count in zip(table["Freq"], table["#Students"]):
-            if isinstance(freq, str):
-                freq = int(freq.replace('>', ''))
-            freq_data.extend([freq] * count)
-
-        if freq_data:
-            mean_val = sum(freq_data) / len(freq_data)
-            median_val = sorted(freq_data)[len(freq_data)//2]
-            
-            fig.add_vline(x=mean_val, line_dash="dash", line_color="red",
-                         annotation_text=f"Mean: {mean_val:.2f}",
-                         annotation_position="top right",
-                         annotation_y=1.1)
-            
-            fig.add_vline(x=median_val, line_dash="dash", line_color="green",
-                         annotation_text=f"Median: {median_val:.2f}",
-                         annotation_position="bottom right",
-                         annotation_y=0.9)
-
         # Create title with date range
         title = 'Booking Frequency Distribution'
         if analysis_type == 'Monthly':
             title += f' ({period_values[0]})'
         else:
             title += f' ({period_values[0]} to {period_values[1]})'
-            
-        fig.update_layout(
-            title=title,
-            xaxis_title='Frequency of Bookings',
-            yaxis_title='Number of Students',
-            height=500
-        )
+
+        fig = create_histogram(table, title)
 
         # Create table
-        table_component = html.Table([
-            html.Thead(
-                html.Tr([
-                    html.Th(col, className="p-3 text-left font-medium text-gray-600 border") 
-                    for col in table.columns
-                ], className="bg-gray-50")
-            ),
-            html.Tbody([
-                html.Tr([
-                    html.Td(row[col], className="p-3 border") 
-                    for col in table.columns
-                ], className="hover:bg-gray-50")
-                for _, row in table.iterrows()
-            ])
-        ], className="min-w-full divide-y divide-gray-200")
+        table_component = dash_table.DataTable(
+            columns=[{"name": col, "id": col} for col in table.columns],
+            data=table.to_dict("records"),
+            style_cell={"padding": "12px", "border": "1px solid #eee", "textAlign": "left",
+                        "whiteSpace": "normal", "height": "auto"},
+            style_header={"backgroundColor": "#f9fafb", "fontWeight": "500", "color": "#4b5563"}
+        )
 
-        return fig, table_component, {'display': 'block'}, "Analysis completed successfully", "text-green-600",""
+        return fig, table_component, {'display': 'block'}, "Analysis completed successfully", "text-green-600","", table.to_dict("split")
 
     except Exception as e:
-        return dash.no_update, dash.no_update, {'display': 'none'}, f"Error: {str(e)}", "text-red-600", ""
+        return dash.no_update, dash.no_update, {'display': 'none'}, f"Error: {str(e)}", "text-red-600", "", None
 
 @app.callback(
     Output("download-xlsx", "data"),
     Input("btn-export-data", "n_clicks"),
-    [State('stored-data', 'data'),
-     State('analysis-type', 'value'),
-     State('max-upper', 'value'),
-     State({'type': 'period', 'mode': ALL}, 'value')],
+    State('last-table', 'data'),
     prevent_initial_call=True
 )
-def export_data(n_clicks, stored_data, analysis_type, max_upper, period_values):
-    if not n_clicks or not stored_data:
+def export_data(n_clicks, last_table):
+    if not n_clicks or not last_table:
         raise PreventUpdate
 
     try:
-        data = pd.read_json(StringIO(stored_data['data']), orient='split')
-        if analysis_type == 'Monthly':
-            period_value = period_values[0] if period_values else None
-            if not period_value:
-                raise PreventUpdate
-            table = create_frequency_table(data, period=period_value, max_upper=max_upper)
-        else:
-            if len(period_values) < 2:
-                raise PreventUpdate
-            table = create_frequency_table(data, start_period=period_values[0], 
-                                        end_period=period_values[1], max_upper=max_upper)
-
-        if table is None:
-            raise PreventUpdate
-
-        return dcc.send_data_frame(table.to_excel, "booking_frequency.xlsx", sheet_name="Frequency Analysis")
+        # Export exactly what the last analysis produced instead of recomputing it
+        table = pd.DataFrame(**last_table)
+        return dcc.send_bytes(excel_writer(table), "booking_frequency.xlsx")
     except Exception:
         raise PreventUpdate
         